@@ -14,9 +14,14 @@
 # limitations under the License.
 """Feature extractor class for Granite Speech."""
 
+import copy
+import hashlib
+import json
 import math
+import os
 from collections.abc import Sequence
-from typing import Optional
+from functools import lru_cache
+from typing import Any, Optional, Union
 
 import numpy as np
 
@@ -35,8 +40,128 @@ if is_torchaudio_available():
     import torchaudio
 
 
+def _normalize_log_mel(mel: "torch.Tensor") -> "torch.Tensor":
+    """
+    Converts a mel spectrogram of shape `(batch, n_mels, frames)` into normalized
+    log-mel features of shape `(batch, frames, n_mels)`. Note that `mel` is modified in place.
+    """
+    logmel = mel.transpose(-1, -2).clip_(min=1e-10).log10_()
+    mx = logmel.amax(dim=(-2, -1), keepdim=True)
+    return torch.maximum(logmel, mx - 8.0).div_(4).add_(1)
+
+
+@lru_cache(maxsize=1)
+def _get_compiled_normalize_log_mel():
+    # Compiling lets inductor fuse the clip / log / max / affine chain into a
+    # single kernel instead of launching one kernel per op.
+    return torch.compile(_normalize_log_mel, dynamic=True)
+
+
+class _MelSpectrogram:
+    """
+    Mel spectrogram matching `torchaudio.transforms.MelSpectrogram` with its default settings (centered
+    reflect padding, hann window, power spectrum, HTK mel scale). Rather than going through torchaudio's
+    transforms, the windowed frames are passed to a single `rfft`, followed by one matmul with the mel
+    filter bank; since this only uses `torch` ops, it also works with `torch.compile`.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int,
+        n_fft: int,
+        win_length: int,
+        hop_length: int,
+        n_mels: int,
+        device: Union[str, "torch.device"] = "cpu",
+    ):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        n_freqs = n_fft // 2 + 1
+
+        # the window is zero padded to n_fft on both sides, as done by torch.stft
+        window = torch.hann_window(win_length, device=device)
+        left_pad = (n_fft - win_length) // 2
+        self.window = torch.nn.functional.pad(window, (left_pad, n_fft - win_length - left_pad))
+        # shape (n_mels, n_freqs)
+        self.mel_fb = (
+            torchaudio.functional.melscale_fbanks(
+                n_freqs,
+                f_min=0.0,
+                f_max=float(sample_rate // 2),
+                n_mels=n_mels,
+                sample_rate=sample_rate,
+            )
+            .T.contiguous()
+            .to(device)
+        )
+
+    def _pad(self, audio: "torch.Tensor") -> "torch.Tensor":
+        """Reflect pads audio of shape `(batch, time)` to center the frames, returning shape `(batch, 1, time)`."""
+        pad = self.n_fft // 2
+        return torch.nn.functional.pad(audio.unsqueeze(1), (pad, pad), mode="reflect")
+
+    def __call__(self, audio: "torch.Tensor") -> "torch.Tensor":
+        """
+        Computes the mel spectrogram of shape `(batch, n_mels, frames)` for audio of shape `(batch, time)`.
+        """
+        # half precision audio is only upcast once it is on the processing device, which keeps the
+        # host to device copy small; the FFT itself runs in fp32, since half precision limits the
+        # dynamic range of the spectrum
+        frames = self._pad(audio.float()).squeeze(1).unfold(-1, self.n_fft, self.hop_length) * self.window
+        spec = torch.fft.rfft(frames, dim=-1)
+        power = spec.real.square() + spec.imag.square()
+        return torch.matmul(self.mel_fb, power.transpose(-1, -2))
+
+
+class _FusedMelSpectrogram(_MelSpectrogram):
+    """
+    Variant of `_MelSpectrogram` which computes the STFT as a single strided convolution over windowed DFT
+    bases, which can make better use of the hardware on accelerators than an FFT for small `n_fft`.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int,
+        n_fft: int,
+        win_length: int,
+        hop_length: int,
+        n_mels: int,
+        device: Union[str, "torch.device"] = "cpu",
+    ):
+        super().__init__(sample_rate, n_fft, win_length, hop_length, n_mels, device=device)
+        n_freqs = n_fft // 2 + 1
+
+        # reduce k * t modulo n_fft before going to float to keep the angles precise
+        k = torch.arange(n_freqs, device=device).view(-1, 1)
+        t = torch.arange(n_fft, device=device).view(1, -1)
+        angles = (2 * math.pi / n_fft) * ((k * t) % n_fft).float()
+        # real & imaginary windowed DFT bases; shape (2 * n_freqs, 1, n_fft). These are kept
+        # in fp32, since rounding them to half precision leaks energy between frequency bins.
+        dft_weights = torch.cat([torch.cos(angles), -torch.sin(angles)], dim=0) * self.window
+        self.dft_weights = dft_weights.unsqueeze(1)
+
+    def __call__(self, audio: "torch.Tensor") -> "torch.Tensor":
+        """
+        Computes the mel spectrogram of shape `(batch, n_mels, frames)` for audio of shape `(batch, time)`.
+        """
+        audio = self._pad(audio.float())
+        spec = torch.nn.functional.conv1d(audio, self.dft_weights, stride=self.hop_length)
+        real, imag = spec.chunk(2, dim=1)
+        power = real * real + imag * imag
+        return torch.matmul(self.mel_fb, power)
+
+
+@lru_cache(maxsize=1)
+def _get_compiled_fused_mel_spectrogram():
+    # Compiling the unbound method lets inductor fuse the padding, strided
+    # convolution and power / mel projection; the transform is passed as an input.
+    return torch.compile(_FusedMelSpectrogram.__call__, dynamic=True)
+
+
 class GraniteSpeechFeatureExtractor(FeatureExtractionMixin):
     model_input_names = ["input_features"]
+    # runtime state / local settings which are not part of the serialized config
+    _unserialized_attributes = ("_melspec_cache", "_compile_failed", "features_cache_dir")
 
     def __init__(
         self,
@@ -47,6 +172,10 @@ class GraniteSpeechFeatureExtractor(FeatureExtractionMixin):
         n_mels: int = 80,
         projector_window_size: int = 15,
         projector_downsample_rate: int = 5,
+        use_torch_compile: bool = False,
+        use_fused_mel: bool = False,
+        chunk_length_s: Optional[float] = 30,
+        features_cache_dir: Optional[str] = None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -59,23 +188,40 @@ class GraniteSpeechFeatureExtractor(FeatureExtractionMixin):
             "n_mels": n_mels,
         }
         requires_backends(self, ["torchaudio"])
-        self.mel_filters = torchaudio.transforms.MelSpectrogram(**self.melspec_kwargs)
+        # Mel transforms are built lazily, one per device, so that the filter
+        # bank and window are only moved to a given device once.
+        self._melspec_cache = {}
         self.projector_window_size = projector_window_size
         self.projector_downsample_rate = projector_downsample_rate
+        self.use_torch_compile = use_torch_compile
+        # set if compilation fails at runtime, so that eager mode is used from then on
+        # without changing the (serialized) use_torch_compile setting
+        self._compile_failed = False
+        self.use_fused_mel = use_fused_mel
+        self.chunk_length_s = chunk_length_s
+        # Optional on-disk cache of features for unbatched audio, keyed by a hash
+        # of the waveform; this trades disk space for recomputing the features.
+        self.features_cache_dir = features_cache_dir
 
     def __call__(
         self,
         audios: AudioInput,
         device: Optional[str] = "cpu",
+        return_device: Optional[str] = None,
     ) -> BatchFeature:
         requires_backends(self, ["torchaudio"])
 
         speech_inputs = {}
-        batched_audio, audio_lengths = self._get_audios_and_audio_lengths(audios)
-        speech_inputs["input_features"] = self._extract_mel_spectrograms(
+        batched_audio, audio_lengths = self._get_audios_and_audio_lengths(audios, device=device)
+        input_features = self._extract_mel_spectrograms(
             batched_audio,
             device=device,
         )
+        # Features are left on the processing device unless the caller
+        # explicitly asks for them elsewhere, to avoid a device round-trip.
+        if return_device is not None:
+            input_features = input_features.to(return_device)
+        speech_inputs["input_features"] = input_features
         audio_embed_sizes = self._get_num_audio_features(audio_lengths)
         speech_inputs["audio_embed_sizes"] = audio_embed_sizes
         # TODO (@alex-jw-brooks): Currently input_features_mask is not
@@ -87,72 +233,216 @@ class GraniteSpeechFeatureExtractor(FeatureExtractionMixin):
         # has the same dimensionality as input_features, or compute it in
         # the model based on the audio embedding sizes (since we do not
         # have an attention mask for the audio features to infer padding from).
-        speech_inputs["input_features_mask"] = torch.arange(max(audio_embed_sizes)).view(1, -1) < torch.tensor(
-            audio_embed_sizes
-        ).view(-1, 1)
+        feature_positions = torch.arange(max(audio_embed_sizes), device=input_features.device)
+        # the lengths are staged in pinned memory when moving them to CUDA, so that
+        # the copy does not block the host until the features have been computed
+        feature_lengths = torch.tensor(audio_embed_sizes, pin_memory=input_features.is_cuda)
+        feature_lengths = feature_lengths.to(input_features.device, non_blocking=True)
+        speech_inputs["input_features_mask"] = feature_positions.view(1, -1) < feature_lengths.view(-1, 1)
         return BatchFeature(data=speech_inputs)
 
+    @classmethod
+    def from_dict(cls, feature_extractor_dict: dict[str, Any], **kwargs):
+        # the features cache directory is a local setting that is never serialized,
+        # so it can only be enabled through the loading kwargs
+        if "features_cache_dir" in kwargs:
+            feature_extractor_dict = {**feature_extractor_dict, "features_cache_dir": kwargs.pop("features_cache_dir")}
+        return super().from_dict(feature_extractor_dict, **kwargs)
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Serializes this instance to a Python dictionary.
+
+        Returns:
+            `dict[str, Any]`: Dictionary of all the attributes that make up this feature extractor instance, except for
+            the cached mel transforms, which are rebuilt on demand, and the local features cache directory.
+        """
+        output = copy.deepcopy({k: v for k, v in self.__dict__.items() if k not in self._unserialized_attributes})
+        output["feature_extractor_type"] = self.__class__.__name__
+        return output
+
+    def _ensure_melspec_transform_is_initialized(self, device: Union[str, "torch.device"] = "cpu") -> _MelSpectrogram:
+        """
+        Gets the mel spectrogram transform for the provided device, creating and caching it
+        on first use to avoid copying the filter bank / window to the device on every call.
+        If `use_fused_mel` is set, the convolution based implementation is used instead of the FFT based one.
+
+        Args:
+            device (`str` or `torch.device`, *optional*, defaults to `"cpu"`):
+                Device that the mel spectrogram transform should live on.
+        """
+        requires_backends(self, ["torchaudio"])
+        key = torch.device(device)
+        if key not in self._melspec_cache:
+            melspec_cls = _FusedMelSpectrogram if self.use_fused_mel else _MelSpectrogram
+            self._melspec_cache[key] = melspec_cls(**self.melspec_kwargs, device=key)
+        return self._melspec_cache[key]
+
     def _extract_mel_spectrograms(self, audio: "torch.Tensor", device="cpu"):
         """
         Compute the Mel features to be passed to the conformer encoder.
         """
         requires_backends(self, ["torchaudio"])
+        cache_path = self._get_features_cache_path(audio, device=device)
+        if cache_path is not None and os.path.isfile(cache_path):
+            # copy-on-write memory map, so that the features are only read from disk when used
+            cached_features = torch.from_numpy(np.load(cache_path, mmap_mode="c"))
+            return cached_features.to(device) if device is not None else cached_features
+
         if device is not None:
-            melspec = self.mel_filters.to(device)
-            audio = audio.to(device)
-        else:
-            melspec = self.mel_filters
+            # NOTE: if the audio is in pinned memory, this copy is asynchronous,
+            # so it should not be modified by the caller until it has completed
+            audio = audio.to(device, non_blocking=True)
+        melspec = self._ensure_melspec_transform_is_initialized(audio.device)
 
         bsz = audio.shape[0]
-        with torch.no_grad():
+        with torch.inference_mode():
             # Compute mel features
-            mel = melspec(audio.float())
-            logmel = mel.transpose(-1, -2).clip_(min=1e-10).log10_()
-            mx = logmel.amax(dim=(-2, -1), keepdim=True)
-            logmel = torch.maximum(logmel, mx - 8.0).div_(4).add_(1)
-            # remove last frame if odd
-            if logmel.shape[1] % 2 == 1:
-                logmel = logmel[:, :-1]
-
-            # stacking and skipping by 2
-            audio = logmel.reshape(bsz, -1, 2 * logmel.shape[-1])
-
-        if audio.device != "cpu":
-            return audio.detach().cpu()
+            mel = self._compute_mel_spectrogram(melspec, audio)
+            logmel = self._compute_log_mel(mel)
+            # remove last frame if odd; the frame still contributes to the
+            # normalization above, so it can't be skipped before the STFT
+            logmel = logmel[:, : logmel.shape[1] // 2 * 2]
+
+        # stacking and skipping by 2; the (transposed) log-mel features are copied
+        # outside of inference mode, so that the returned tensor can still be used
+        # in autograd, e.g., when training the model
+        logmel = logmel.clone(memory_format=torch.contiguous_format)
+        audio = logmel.view(bsz, -1, 2 * logmel.shape[-1])
+
+        if cache_path is not None:
+            self._save_cached_features(cache_path, audio)
         return audio
 
-    def _get_num_audio_features(self, audio_lengths: Sequence[int]) -> Sequence[int]:
+    def _get_features_cache_path(self, audio: "torch.Tensor", device: Optional[str] = None) -> Optional[str]:
+        """
+        Gets the path that the features for the given audio are cached under, or `None` if they should not
+        be cached, i.e., if no `features_cache_dir` is set or the audio is batched.
+        """
+        if self.features_cache_dir is None or audio.shape[0] != 1:
+            return None
+        # the mel transforms may run at a different precision depending on the device type
+        device_type = torch.device(device).type if device is not None else audio.device.type
+
+        # the key also encodes everything that affects the features besides the waveform itself
+        salt = json.dumps(
+            {
+                **self.melspec_kwargs,
+                "use_fused_mel": self.use_fused_mel,
+                "device_type": device_type,
+                "dtype": str(audio.dtype),
+                "shape": list(audio.shape),
+            },
+            sort_keys=True,
+        )
+        waveform_bytes = audio.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes()
+        key = hashlib.blake2b(waveform_bytes + salt.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.features_cache_dir, f"{key}.npy")
+
+    @staticmethod
+    def _save_cached_features(cache_path: str, features: "torch.Tensor"):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # write to a temporary file first so that concurrent readers never see a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, features.cpu().numpy())
+        os.replace(tmp_path, cache_path)
+
+    def _compute_mel_spectrogram(
+        self,
+        melspec: _MelSpectrogram,
+        audio: "torch.Tensor",
+    ) -> "torch.Tensor":
+        """
+        Computes the mel spectrogram of shape `(batch, n_mels, frames)`. Audio longer than `chunk_length_s`
+        seconds is processed in chunks, which bounds the memory used by the STFT intermediates; each chunk
+        is given enough context on both sides for the frames that are kept to be identical to the unchunked ones.
+        """
+        hop_length = self.melspec_kwargs["hop_length"]
+        num_frames = audio.shape[-1] // hop_length + 1
+        chunk_frames = num_frames
+        if self.chunk_length_s is not None:
+            chunk_frames = max(int(self.chunk_length_s * self.sampling_rate) // hop_length, 1)
+
+        if num_frames <= chunk_frames:
+            return self._apply_melspec(melspec, audio)
+
+        # frames of context needed so that no kept frame overlaps the padding added at the chunk edges
+        context_frames = self.melspec_kwargs["n_fft"] // 2 // hop_length + 1
+        mel = torch.empty(
+            (audio.shape[0], self.melspec_kwargs["n_mels"], num_frames), dtype=torch.float32, device=audio.device
+        )
+        for start in range(0, num_frames, chunk_frames):
+            end = min(start + chunk_frames, num_frames)
+            context_start = max(start - context_frames, 0)
+            chunk = audio[..., context_start * hop_length : (end - 1 + context_frames) * hop_length]
+            offset = start - context_start
+            mel[..., start:end] = self._apply_melspec(melspec, chunk)[..., offset : offset + end - start]
+        return mel
+
+    def _apply_melspec(self, melspec: _MelSpectrogram, audio: "torch.Tensor") -> "torch.Tensor":
+        """
+        Applies the mel spectrogram transform, using a compiled kernel for the fused transform if `use_torch_compile`
+        is set.
+        """
+        if self.use_torch_compile and self.use_fused_mel and not self._compile_failed:
+            try:
+                return _get_compiled_fused_mel_spectrogram()(melspec, audio)
+            except torch._dynamo.exc.BackendCompilerFailed as e:
+                # e.g., no compiler / triton available for this device; errors
+                # raised when running the compiled kernel are not caught here
+                logger.warning_once(f"Failed to compile the fused mel spectrogram; falling back to eager mode: {e}")
+                self._compile_failed = True
+        return melspec(audio)
+
+    def _compute_log_mel(self, mel: "torch.Tensor") -> "torch.Tensor":
+        """
+        Computes the normalized log-mel features, using a compiled kernel if `use_torch_compile` is set.
+        """
+        if self.use_torch_compile and not self._compile_failed:
+            try:
+                return _get_compiled_normalize_log_mel()(mel)
+            except torch._dynamo.exc.BackendCompilerFailed as e:
+                # e.g., no compiler / triton available for this device; errors
+                # raised when running the compiled kernel are not caught here
+                logger.warning_once(f"Failed to compile log-mel computation; falling back to eager mode: {e}")
+                self._compile_failed = True
+        return _normalize_log_mel(mel)
+
+    def _get_num_audio_features(self, audio_lengths: Union[Sequence[int], "torch.Tensor"]) -> list[int]:
         """
         Gets the (variable length) number of features (i.e., projector output) for the sequences
         being considered.
 
         Args:
-            audio_lengths (`Sequence[int]`):
+            audio_lengths (`Sequence[int]` or `torch.Tensor`):
                 Sequence of one or more raw audio lengths.
         """
         hop_length = self.melspec_kwargs["hop_length"]
-        effective_window_size = self.projector_window_size // self.projector_downsample_rate
+        window_size = self.projector_window_size
+        effective_window_size = window_size // self.projector_downsample_rate
 
-        projector_lengths = []
-        for raw_length in audio_lengths:
-            # mel sequence length computation
-            mel_length = raw_length // hop_length + 1
-            # encoder frame takes two mel features
-            encoder_length = mel_length // 2
-            nblocks = math.ceil(encoder_length / self.projector_window_size)
-            # projector output length
-            projector_length = nblocks * effective_window_size
-            projector_lengths.append(projector_length)
+        raw_lengths = torch.as_tensor(audio_lengths, dtype=torch.long)
+        # mel sequence length computation
+        mel_lengths = raw_lengths // hop_length + 1
+        # encoder frame takes two mel features
+        encoder_lengths = mel_lengths // 2
+        nblocks = (encoder_lengths + window_size - 1) // window_size
+        # projector output length
+        projector_lengths = nblocks * effective_window_size
+        return projector_lengths.tolist()
 
-        return projector_lengths
-
-    def _get_audios_and_audio_lengths(self, audios: AudioInput) -> Sequence["torch.Tensor", Sequence[int]]:
+    def _get_audios_and_audio_lengths(
+        self, audios: AudioInput, device: Optional[str] = None
+    ) -> Sequence["torch.Tensor", Sequence[int]]:
         """
         Coerces audio inputs to torch tensors and extracts audio lengths prior to stacking.
 
         Args:
             audios (`AudioInput`):
                 Audio sequence, numpy array, or torch tensor.
+            device (`str`, *optional*):
+                Device to stack lists of audios on; if unset, audios are stacked on their current device.
         """
         requires_backends(self, ["torch"])
 
@@ -178,12 +468,23 @@ class GraniteSpeechFeatureExtractor(FeatureExtractionMixin):
             if not torch.is_floating_point(audios[0]):
                 raise ValueError("Invalid audio provided. Audio should be a floating point between 0 and 1")
             lengths = [audio.shape[-1] for audio in audios]
-            padding = [max(lengths) - length for length in lengths]
-            # ensure all audios have a batch dimension:
-            audios = [audio.view(1, -1) for audio in audios]
-            padded = [torch.nn.functional.pad(audio, (0, pad)) for audio, pad in zip(audios, padding)]
-            audios = torch.cat(padded, dim=0)
-            return audios, lengths
+            target_device = torch.device(device) if device is not None else audios[0].device
+            # when moving CPU audio to CUDA, collate into pinned memory so that
+            # the batch is moved with a single asynchronous copy
+            pin_memory = target_device.type == "cuda" and audios[0].device.type == "cpu"
+            # allocate the padded batch once (on the target device, if there is
+            # one) and copy each audio into it, rather than padding each one
+            batched_audio = torch.zeros(
+                (len(audios), max(lengths)),
+                dtype=audios[0].dtype,
+                device="cpu" if pin_memory else target_device,
+                pin_memory=pin_memory,
+            )
+            for idx, (audio, length) in enumerate(zip(audios, lengths)):
+                batched_audio[idx, :length].copy_(audio.reshape(-1), non_blocking=True)
+            if pin_memory:
+                batched_audio = batched_audio.to(target_device, non_blocking=True)
+            return batched_audio, lengths
 
         raise TypeError("Invalid audio provided. Audio should be a one or more torch tensors or numpy arrays")
 
@@ -14,11 +14,14 @@
 # limitations under the License.
 """Processor class for Granite Speech."""
 
-from typing import Union
+from collections.abc import Iterator
+from contextlib import nullcontext
+from typing import Optional, Union
 
 from ...feature_extraction_utils import BatchFeature
 from ...processing_utils import ProcessorMixin
 from ...tokenization_utils import PreTokenizedInput, TextInput
+from ...tokenization_utils_base import BatchEncoding
 from ...utils import is_torch_available, logging
 from ...utils.import_utils import requires_backends
 
@@ -33,6 +36,13 @@ class GraniteSpeechProcessor(ProcessorMixin):
     attributes = ["audio_processor", "tokenizer"]
     audio_processor_class = "GraniteSpeechFeatureExtractor"
     tokenizer_class = "AutoTokenizer"
+    # tokenizer options that are applied when padding the token level expansion of audio tokens
+    _token_level_padding_kwargs = ("padding", "max_length", "pad_to_multiple_of", "padding_side", "return_tensors")
+    _token_level_expansion_kwargs = _token_level_padding_kwargs + (
+        "add_special_tokens",
+        "return_attention_mask",
+        "return_token_type_ids",
+    )
 
     def __init__(
         self,
@@ -49,56 +59,189 @@ class GraniteSpeechProcessor(ProcessorMixin):
         text: Union[TextInput, PreTokenizedInput, list[TextInput], list[PreTokenizedInput]],
         audio: Union["torch.Tensor", list["torch.Tensor"]] = None,
         device: str = "cpu",
+        return_device: Optional[str] = None,
+        expand_at_token_level: bool = False,
         images=None,
         videos=None,
         **kwargs,
     ) -> BatchFeature:
         requires_backends(self, ["torch"])
 
-        text = self._get_validated_text(text)
+        text, audio_positions = self._get_validated_text_and_positions(text)
         prompt_strings = text
+        audio_embed_sizes = None
+        # When processing audio on CUDA, the features are computed on a side stream so
+        # that the GPU work overlaps with tokenization, which is done on the CPU
+        audio_stream = None
 
         if audio is not None:
+            if device is not None and torch.device(device).type == "cuda":
+                audio_stream = torch.cuda.Stream(device)
+                # audio that is already on the device may still be being written by the caller's stream
+                audio_stream.wait_stream(torch.cuda.current_stream(device))
+
             # NOTE - we intentionally avoid throwing for potentially misaligned
             # text / audio inputs here because some inference engines will
             # trigger the conditions due to the way they call multimodal
             # processors, e.g., vLLM.
-            audio_inputs = self.audio_processor(audio, device=device)
+            with torch.cuda.stream(audio_stream) if audio_stream is not None else nullcontext():
+                audio_inputs = self.audio_processor(audio, device=device, return_device=return_device)
 
             # TODO (@alex-jw-brooks); we should add a util to get_num_audio_tokens
             # from feature lengths and call it here, rather than returning it
             # from the feature extractor.
             audio_embed_sizes = audio_inputs.pop("audio_embed_sizes")
-
-            # Expand the audio placeholders to match the feature dims; this
-            # is similar to how many VLMs handle image tokens, e.g., llava next
-            prompt_strings = []
-            num_replaced = 0
-            for sample in text:
-                while self.audio_token in sample:
-                    sample = sample.replace(
-                        self.audio_token,
-                        "<placeholder>" * audio_embed_sizes[num_replaced],
-                        1,
-                    )
-                    num_replaced += 1
-                prompt_strings.append(sample)
-
-            prompt_strings = [sample.replace("<placeholder>", self.audio_token) for sample in prompt_strings]
         else:
             audio_inputs = {}
 
         if "padding" not in kwargs:
             kwargs["padding"] = True
-        text_inputs = self.tokenizer(prompt_strings, **kwargs)
-        return BatchFeature(data={**text_inputs, **audio_inputs})
 
-    def _get_validated_text(self, text: Union[str, list]) -> list[str]:
+        if audio_embed_sizes is not None and expand_at_token_level and self._can_expand_at_token_level(kwargs):
+            text_inputs = self._tokenize_and_expand_audio_tokens(text, audio_embed_sizes, **kwargs)
+        else:
+            if audio_embed_sizes is not None:
+                # Expand the audio placeholders to match the feature dims; this
+                # is similar to how many VLMs handle image tokens, e.g., llava next
+                if len(audio_positions) == 1 and len(audio_positions[0]) == 1 and len(audio_embed_sizes) == 1:
+                    # fast path for the common case of a single prompt with one audio
+                    prompt_strings = [text[0].replace(self.audio_token, self.audio_token * audio_embed_sizes[0], 1)]
+                else:
+                    prompt_strings = self._expand_audio_placeholders(text, audio_positions, audio_embed_sizes)
+            text_inputs = self.tokenizer(prompt_strings, **kwargs)
+
+        if audio_stream is not None:
+            # make the caller's stream wait for the audio features, and make sure the
+            # caching allocator knows they are used on it before reusing their memory
+            current_stream = torch.cuda.current_stream(device)
+            current_stream.wait_stream(audio_stream)
+            for value in audio_inputs.values():
+                if isinstance(value, torch.Tensor) and value.is_cuda:
+                    value.record_stream(current_stream)
+
+        outputs = BatchFeature(data={**text_inputs, **audio_inputs})
+        # the audio outputs are left on the processing device unless a return
+        # device is given, so the text outputs are moved to match them
+        output_device = return_device if return_device is not None else device
+        if output_device is not None:
+            outputs = outputs.to(output_device)
+        return outputs
+
+    def _can_expand_at_token_level(self, kwargs: dict) -> bool:
+        """
+        Checks whether the audio tokens can be expanded after tokenization, which requires the audio token to
+        be a single (added) token, and no tokenizer options whose result depends on the expanded length, e.g.,
+        truncation.
+        """
+        if self.audio_token not in self.tokenizer.added_tokens_encoder:
+            return False
+        return set(kwargs).issubset(self._token_level_expansion_kwargs)
+
+    def _tokenize_and_expand_audio_tokens(
+        self, text: list[str], num_audio_features: list[int], **kwargs
+    ) -> BatchEncoding:
+        """
+        Tokenizes the text with a single audio token per audio, then repeats each audio token
+        to match the number of features of its corresponding audio before padding; every per-token
+        output of the tokenizer, e.g., the attention mask or token type ids, is expanded along with
+        the input ids. This avoids building and tokenizing the (potentially very long) expanded
+        prompt strings.
+
+        Args:
+            text (`list[str]`):
+                Text samples containing audio tokens.
+            num_audio_features (`list[int]`):
+                Number of audio features for each audio token present in the text.
+        """
+        pad_kwargs = {key: kwargs.pop(key) for key in self._token_level_padding_kwargs if key in kwargs}
+        if "return_attention_mask" in kwargs:
+            pad_kwargs["return_attention_mask"] = kwargs["return_attention_mask"]
+        text_inputs = self.tokenizer(text, padding=False, **kwargs)
+        audio_token_id = self.tokenizer.convert_tokens_to_ids(self.audio_token)
+
+        num_features_iter = iter(num_audio_features)
+        encoded_inputs = {key: [] for key in text_inputs}
+        for idx, ids in enumerate(text_inputs["input_ids"]):
+            sample_inputs = {key: values[idx] for key, values in text_inputs.items()}
+            expanded = {key: [] for key in sample_inputs}
+            start = 0
+            for pos in [pos for pos, token_id in enumerate(ids) if token_id == audio_token_id]:
+                num_features = self._next_num_audio_features(num_features_iter)
+                for key, values in sample_inputs.items():
+                    expanded[key].extend(values[start:pos])
+                    expanded[key].extend([values[pos]] * num_features)
+                start = pos + 1
+            for key, values in sample_inputs.items():
+                expanded[key].extend(values[start:])
+                encoded_inputs[key].append(expanded[key])
+        return self.tokenizer.pad(encoded_inputs, **pad_kwargs)
+
+    @staticmethod
+    def _next_num_audio_features(num_features_iter: Iterator[int]) -> int:
+        """
+        Gets the number of features for the next audio token, raising if there are more audio tokens than audios.
+        """
+        try:
+            return next(num_features_iter)
+        except StopIteration:
+            raise ValueError("The text contains more audio tokens than the number of audios provided.") from None
+
+    def _expand_audio_placeholders(
+        self, text: list[str], audio_positions: list[list[int]], num_audio_features: list[int]
+    ) -> list[str]:
+        """
+        Expands each audio token in the text to the number of features of its corresponding
+        audio, consuming `num_audio_features` in order across all samples.
+
+        Args:
+            text (`list[str]`):
+                Text samples containing audio tokens.
+            audio_positions (`list[list[int]]`):
+                Start offsets of the audio tokens in each text sample.
+            num_audio_features (`list[int]`):
+                Number of audio features for each audio token present in the text.
+        """
+        token_len = len(self.audio_token)
+        num_features_iter = iter(num_audio_features)
+        # audios often share the same number of features, so the
+        # expanded token runs are built once per distinct length
+        audio_token_runs = {}
+        prompt_strings = []
+        for sample, positions in zip(text, audio_positions):
+            # slice around the known token positions and join once, so
+            # that each sample is only scanned and built a single time
+            expanded = []
+            start = 0
+            for pos in positions:
+                num_features = self._next_num_audio_features(num_features_iter)
+                if num_features not in audio_token_runs:
+                    audio_token_runs[num_features] = self.audio_token * num_features
+                expanded.append(sample[start:pos])
+                expanded.append(audio_token_runs[num_features])
+                start = pos + token_len
+            expanded.append(sample[start:])
+            prompt_strings.append("".join(expanded))
+        return prompt_strings
+
+    def _get_validated_text_and_positions(self, text: Union[str, list]) -> tuple[list[str], list[list[int]]]:
+        """
+        Validates the text, returning it as a list along with the start offsets of
+        the audio tokens in each sample, so that the text only needs to be scanned once.
+        """
         if isinstance(text, str):
-            return [text]
-        elif isinstance(text, list) and isinstance(text[0], str):
-            return text
-        raise TypeError("Invalid text provided! Text should be a string or list of strings.")
+            text = [text]
+        elif not (isinstance(text, list) and isinstance(text[0], str)):
+            raise TypeError("Invalid text provided! Text should be a string or list of strings.")
+
+        audio_positions = []
+        for sample in text:
+            positions = []
+            pos = sample.find(self.audio_token)
+            while pos != -1:
+                positions.append(pos)
+                pos = sample.find(self.audio_token, pos + len(self.audio_token))
+            audio_positions.append(positions)
+        return text, audio_positions
 
 
 __all__ = ["GraniteSpeechProcessor"]
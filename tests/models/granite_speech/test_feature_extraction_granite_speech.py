@@ -0,0 +1,171 @@
+# Copyright 2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import math
+import os
+import tempfile
+import unittest
+
+from parameterized import parameterized
+
+from transformers.testing_utils import require_torch, require_torch_gpu, require_torchaudio
+from transformers.utils import is_torch_available, is_torchaudio_available
+
+
+if is_torch_available():
+    import torch
+
+if is_torchaudio_available():
+    import torchaudio
+
+    from transformers import GraniteSpeechFeatureExtractor
+
+
+@require_torch
+@require_torchaudio
+class GraniteSpeechFeatureExtractorTest(unittest.TestCase):
+    def test_to_json_string_skips_melspec_cache(self):
+        """Ensure the cached mel transforms are not serialized."""
+        feature_extractor = GraniteSpeechFeatureExtractor()
+        feature_extractor(torch.empty([1, 16000]).uniform_(-0.5, 0.5))
+
+        feat_extract_dict = json.loads(feature_extractor.to_json_string())
+        self.assertNotIn("_melspec_cache", feat_extract_dict)
+        self.assertEqual(feat_extract_dict["melspec_kwargs"], feature_extractor.melspec_kwargs)
+
+    @parameterized.expand([(False,), (True,)])
+    def test_mel_spectrogram_matches_torchaudio(self, use_fused_mel):
+        """Ensure the mel spectrogram matches torchaudio's MelSpectrogram."""
+        audio = torch.empty([2, 32000]).uniform_(-0.5, 0.5)
+        feature_extractor = GraniteSpeechFeatureExtractor(use_fused_mel=use_fused_mel)
+        expected = torchaudio.transforms.MelSpectrogram(**feature_extractor.melspec_kwargs)(audio)
+        computed = feature_extractor._ensure_melspec_transform_is_initialized("cpu")(audio)
+
+        self.assertEqual(computed.shape, expected.shape)
+        torch.testing.assert_close(computed, expected, rtol=1e-3, atol=1e-3)
+
+    @parameterized.expand([(False,), (True,)])
+    def test_torch_compile_matches_eager(self, use_fused_mel):
+        """Ensure the (possibly compiled) feature computation matches eager mode without changing the config."""
+        audio = torch.empty([2, 16000]).uniform_(-0.5, 0.5)
+        expected = GraniteSpeechFeatureExtractor(use_fused_mel=use_fused_mel)(audio)["input_features"]
+        feature_extractor = GraniteSpeechFeatureExtractor(use_fused_mel=use_fused_mel, use_torch_compile=True)
+        computed = feature_extractor(audio)["input_features"]
+
+        # make sure the compiled path actually ran, rather than falling back to eager mode
+        self.assertFalse(feature_extractor._compile_failed)
+        torch.testing.assert_close(computed, expected, rtol=1e-4, atol=1e-4)
+        feat_extract_dict = json.loads(feature_extractor.to_json_string())
+        self.assertTrue(feat_extract_dict["use_torch_compile"])
+        self.assertNotIn("_compile_failed", feat_extract_dict)
+
+    def test_torch_compile_fallback_keeps_config(self):
+        """Ensure a failed compilation falls back to eager mode without changing the serialized setting."""
+
+        def failing_backend(graph_module, example_inputs):
+            raise RuntimeError("no compiler available")
+
+        audio = torch.empty([1, 16000]).uniform_(-0.5, 0.5)
+        expected = GraniteSpeechFeatureExtractor()(audio)["input_features"]
+        feature_extractor = GraniteSpeechFeatureExtractor(use_torch_compile=True)
+        with unittest.mock.patch(
+            "transformers.models.granite_speech.feature_extraction_granite_speech._get_compiled_normalize_log_mel",
+            return_value=torch.compile(lambda mel: mel.log10(), backend=failing_backend),
+        ):
+            computed = feature_extractor(audio)["input_features"]
+
+        torch.testing.assert_close(computed, expected)
+        self.assertTrue(feature_extractor._compile_failed)
+        self.assertTrue(json.loads(feature_extractor.to_json_string())["use_torch_compile"])
+
+    def test_torch_compile_runtime_errors_are_raised(self):
+        """Ensure errors raised when running the compiled kernel are not mistaken for compilation failures."""
+        audio = torch.empty([1, 16000]).uniform_(-0.5, 0.5)
+        feature_extractor = GraniteSpeechFeatureExtractor(use_torch_compile=True)
+        with unittest.mock.patch(
+            "transformers.models.granite_speech.feature_extraction_granite_speech._get_compiled_normalize_log_mel",
+            return_value=unittest.mock.Mock(side_effect=RuntimeError("out of memory")),
+        ):
+            with self.assertRaisesRegex(RuntimeError, "out of memory"):
+                feature_extractor(audio)
+        self.assertFalse(feature_extractor._compile_failed)
+
+    @parameterized.expand([(False,), (True,)])
+    @require_torch_gpu
+    def test_mel_spectrogram_precision_on_cuda(self, use_fused_mel):
+        """Ensure audio keeps full precision on CUDA, including half precision audio, which is only upcast."""
+        # a loud tone over low level noise, so that the quiet bins are sensitive to any precision loss
+        time = torch.arange(32000) / 16000
+        audio = 0.5 * torch.sin(2 * math.pi * 300 * time) + torch.empty(32000).uniform_(-1e-3, 1e-3)
+        audio = audio.repeat(2, 1)
+        feature_extractor = GraniteSpeechFeatureExtractor(use_fused_mel=use_fused_mel)
+        expected = torchaudio.transforms.MelSpectrogram(**feature_extractor.melspec_kwargs)(audio)
+        melspec = feature_extractor._ensure_melspec_transform_is_initialized("cuda")
+
+        computed = melspec(audio.to("cuda"))
+        self.assertEqual(computed.dtype, torch.float32)
+        torch.testing.assert_close(computed.cpu(), expected, rtol=1e-3, atol=1e-3)
+
+        # compare against the same (quantized) audio processed on the CPU, which is computed in fp32
+        for dtype in (torch.float16, torch.bfloat16):
+            half_audio = audio.to(dtype)
+            expected_features = feature_extractor(half_audio, device="cpu")["input_features"]
+            features = feature_extractor(half_audio, device="cuda")["input_features"]
+            torch.testing.assert_close(features.cpu(), expected_features, rtol=1e-3, atol=1e-3)
+
+    @require_torch_gpu
+    def test_no_host_sync_on_cuda(self):
+        """Ensure computing features on CUDA does not block the host, so that it can overlap with tokenization."""
+        audio = torch.empty([2, 16000]).uniform_(-0.5, 0.5).pin_memory()
+        feature_extractor = GraniteSpeechFeatureExtractor()
+        # build the mel transform up front, since moving the filter bank to the device synchronizes
+        feature_extractor._ensure_melspec_transform_is_initialized("cuda")
+
+        torch.cuda.set_sync_debug_mode("error")
+        try:
+            speech_inputs = feature_extractor(audio, device="cuda")
+        finally:
+            torch.cuda.set_sync_debug_mode("default")
+        self.assertTrue(speech_inputs["input_features_mask"].is_cuda)
+
+    def test_chunked_mel_matches_unchunked(self):
+        """Ensure processing long audio in chunks gives the same features as a single pass."""
+        audio = torch.empty([2, 50000]).uniform_(-0.5, 0.5)
+        expected = GraniteSpeechFeatureExtractor(chunk_length_s=None)(audio)["input_features"]
+        computed = GraniteSpeechFeatureExtractor(chunk_length_s=0.5)(audio)["input_features"]
+
+        self.assertEqual(computed.shape, expected.shape)
+        torch.testing.assert_close(computed, expected, rtol=1e-4, atol=1e-4)
+
+    def test_features_cache(self):
+        """Ensure features are cached on disk and reused for the same audio."""
+        audio = torch.empty([1, 16000]).uniform_(-0.5, 0.5)
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            GraniteSpeechFeatureExtractor().save_pretrained(tmpdirname)
+            features_cache_dir = os.path.join(tmpdirname, "features")
+            # the features cache can be enabled when loading, since `cache_dir` is reserved for the hub cache
+            feature_extractor = GraniteSpeechFeatureExtractor.from_pretrained(
+                tmpdirname, features_cache_dir=features_cache_dir
+            )
+            expected = feature_extractor(audio)["input_features"]
+            self.assertEqual(len(os.listdir(features_cache_dir)), 1)
+
+            computed = feature_extractor(audio)["input_features"]
+            torch.testing.assert_close(computed, expected)
+            self.assertNotIn("features_cache_dir", json.loads(feature_extractor.to_json_string()))
+            # features computed on different device types may differ in precision, so they are cached separately
+            self.assertNotEqual(
+                feature_extractor._get_features_cache_path(audio, device="cpu"),
+                feature_extractor._get_features_cache_path(audio, device="cuda"),
+            )
@@ -11,13 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import shutil
 import tempfile
 import unittest
 
 import numpy as np
 import pytest
 import torch
+from huggingface_hub import snapshot_download
 from parameterized import parameterized
 
 from transformers import AutoTokenizer, GPT2TokenizerFast
@@ -37,20 +37,34 @@ if is_torchaudio_available():
 @require_torch
 @require_torchaudio
 class GraniteSpeechProcessorTest(unittest.TestCase):
-    def setUp(self):
-        self.tmpdirname = tempfile.mkdtemp()
-        self.checkpoint = "ibm-granite/granite-speech-3.3-8b"
-        processor = GraniteSpeechProcessor.from_pretrained(self.checkpoint)
-        processor.save_pretrained(self.tmpdirname)
+    checkpoint = "ibm-granite/granite-speech-3.3-8b"
+
+    @classmethod
+    def setUpClass(cls):
+        # fetch the checkpoint once, so that all loads below are local reads
+        cls._local_checkpoint = snapshot_download(
+            cls.checkpoint, allow_patterns=["*.json", "*.txt", "*.model", "*.jinja"]
+        )
+        # load the tokenizer / feature extractor once for the whole class
+        cls._tokenizer = AutoTokenizer.from_pretrained(cls._local_checkpoint)
+        cls._audio_processor = GraniteSpeechFeatureExtractor.from_pretrained(cls._local_checkpoint)
+        cls._processor = GraniteSpeechProcessor(tokenizer=cls._tokenizer, audio_processor=cls._audio_processor)
+        cls._audio_token = cls._processor.audio_token
+        cls._audio_token_id = cls._tokenizer.convert_tokens_to_ids(cls._audio_token)
+        # prompts with one audio token per audio in the batch, keyed by batch size
+        cls._audio_prompts = {k: f"{cls._audio_token * k} Can you compare this audio?" for k in (1, 2)}
+        # random audio shared across tests; each test takes (zero-copy) slices of it
+        cls._rand_pool = torch.empty(2, 269920, dtype=torch.float32).uniform_(-0.5, 0.5)
 
     def get_tokenizer(self, **kwargs):
-        return AutoTokenizer.from_pretrained(self.checkpoint, **kwargs)
+        if not kwargs:
+            return self._tokenizer
+        return AutoTokenizer.from_pretrained(self._local_checkpoint, **kwargs)
 
     def get_audio_processor(self, **kwargs):
-        return GraniteSpeechFeatureExtractor.from_pretrained(self.checkpoint, **kwargs)
-
-    def tearDown(self):
-        shutil.rmtree(self.tmpdirname)
+        if not kwargs:
+            return self._audio_processor
+        return GraniteSpeechFeatureExtractor.from_pretrained(self._local_checkpoint, **kwargs)
 
     def test_save_load_pretrained_default(self):
         """Ensure we can save / reload a processor correctly."""
@@ -61,8 +75,9 @@ class GraniteSpeechProcessorTest(unittest.TestCase):
             audio_processor=audio_processor,
         )
 
-        processor.save_pretrained(self.tmpdirname)
-        processor = GraniteSpeechProcessor.from_pretrained(self.tmpdirname)
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            processor.save_pretrained(tmpdirname)
+            processor = GraniteSpeechProcessor.from_pretrained(tmpdirname)
 
         self.assertEqual(processor.tokenizer.get_vocab(), tokenizer.get_vocab())
         self.assertIsInstance(processor.tokenizer, GPT2TokenizerFast)
@@ -70,111 +85,55 @@ class GraniteSpeechProcessorTest(unittest.TestCase):
         self.assertEqual(processor.audio_processor.to_json_string(), audio_processor.to_json_string())
         self.assertIsInstance(processor.audio_processor, GraniteSpeechFeatureExtractor)
 
-    def test_requires_text(self):
-        """Ensure we require text"""
-        tokenizer = self.get_tokenizer()
-        audio_processor = self.get_audio_processor()
-        processor = GraniteSpeechProcessor(
-            tokenizer=tokenizer,
-            audio_processor=audio_processor,
-        )
-
-        with pytest.raises(TypeError):
-            processor(text=None)
-
-    def test_bad_text_fails(self):
-        """Ensure we gracefully fail if text is the wrong type."""
-        tokenizer = self.get_tokenizer()
-        audio_processor = self.get_audio_processor()
-
-        processor = GraniteSpeechProcessor(tokenizer=tokenizer, audio_processor=audio_processor)
-        with pytest.raises(TypeError):
-            processor(text=424, audio=None)
-
-    def test_bad_nested_text_fails(self):
-        """Ensure we gracefully fail if text is the wrong nested type."""
-        tokenizer = self.get_tokenizer()
-        audio_processor = self.get_audio_processor()
-        processor = GraniteSpeechProcessor(
-            tokenizer=tokenizer,
-            audio_processor=audio_processor,
-        )
-
-        with pytest.raises(TypeError):
-            processor(text=[424], audio=None)
-
-    def test_bad_audio_fails(self):
-        """Ensure we gracefully fail if audio is the wrong type."""
-        tokenizer = self.get_tokenizer()
-        audio_processor = self.get_audio_processor()
-        processor = GraniteSpeechProcessor(
-            tokenizer=tokenizer,
-            audio_processor=audio_processor,
-        )
-
-        with pytest.raises(TypeError):
-            processor(text=None, audio="foo")
-
-    def test_nested_bad_audio_fails(self):
-        """Ensure we gracefully fail if audio is the wrong nested type."""
-        tokenizer = self.get_tokenizer()
-        audio_processor = self.get_audio_processor()
-        processor = GraniteSpeechProcessor(
-            tokenizer=tokenizer,
-            audio_processor=audio_processor,
-        )
-
-        with pytest.raises(TypeError):
-            processor(text=None, audio=["foo"])
-
     @parameterized.expand(
         [
-            ([1, 269920], [171], torch.rand),
-            ([1, 269920], [171], np.random.rand),
+            ({"text": None},),
+            ({"text": 424, "audio": None},),
+            ({"text": [424], "audio": None},),
+            ({"text": None, "audio": "foo"},),
+            ({"text": None, "audio": ["foo"]},),
         ]
     )
-    def test_audio_token_filling_same_len_feature_tensors(self, vec_dims, num_expected_features, random_func):
+    def test_bad_inputs_raise(self, kwargs):
+        """Ensure we require text and gracefully fail if text / audio are the wrong (nested) type."""
+        with pytest.raises(TypeError):
+            self._processor(**kwargs)
+
+    @torch.inference_mode()
+    def test_audio_token_filling_same_len_feature_tensors(self):
         """Ensure audio token filling is handled correctly when we have
         one or more audio inputs whose features are all the same length
         stacked into a tensor / numpy array.
-
-        NOTE: Currently we enforce that each sample can only have one audio.
         """
-        tokenizer = self.get_tokenizer()
-        audio_processor = self.get_audio_processor()
-        processor = GraniteSpeechProcessor(
-            tokenizer=tokenizer,
-            audio_processor=audio_processor,
-        )
-        audio = random_func(*vec_dims) - 0.5
-
-        audio_tokens = processor.audio_token * vec_dims[0]
-        inputs = processor(text=f"{audio_tokens} Can you compare this audio?", audio=audio, return_tensors="pt")
-
-        # Check the number of audio tokens
-        audio_token_id = tokenizer.get_vocab()[processor.audio_token]
-
-        # Make sure the number of audio tokens matches the number of features
-        num_computed_features = processor.audio_processor._get_num_audio_features(
-            [vec_dims[1] for _ in range(vec_dims[0])],
-        )
-        num_audio_tokens = int(torch.sum(inputs["input_ids"] == audio_token_id))
-        assert list(inputs["input_features"].shape) == [vec_dims[0], 844, 160]
-        assert sum(num_computed_features) == num_audio_tokens
-
+        processor = self._processor
+        for vec_dims, num_expected_features, as_numpy in [
+            ([1, 269920], [171], False),
+            ([2, 269920], [171, 171], True),
+        ]:
+            with self.subTest(vec_dims=vec_dims, as_numpy=as_numpy):
+                audio = self._rand_pool[: vec_dims[0], : vec_dims[1]]
+                if as_numpy:
+                    # numpy audio is float64, as produced by e.g. np.random.rand
+                    audio = audio.numpy().astype(np.float64)
+
+                inputs = processor(text=self._audio_prompts[vec_dims[0]], audio=audio, return_tensors="pt")
+
+                # Make sure the number of audio tokens matches the number of features
+                num_computed_features = processor.audio_processor._get_num_audio_features([vec_dims[1]] * vec_dims[0])
+                num_audio_tokens = inputs["input_ids"].eq(self._audio_token_id).sum().item()
+                assert list(inputs["input_features"].shape) == [vec_dims[0], 844, 160]
+                assert list(num_computed_features) == num_expected_features
+                assert sum(num_computed_features) == num_audio_tokens
+
+    @torch.inference_mode()
     def test_audio_token_filling_varying_len_feature_list(self):
         """Ensure audio token filling is handled correctly when we have
         multiple varying len audio sequences passed as a list.
         """
-        tokenizer = self.get_tokenizer()
-        audio_processor = self.get_audio_processor()
-        processor = GraniteSpeechProcessor(
-            tokenizer=tokenizer,
-            audio_processor=audio_processor,
-        )
+        processor = self._processor
         vec_dims = [[1, 142100], [1, 269920]]
         num_expected_features = [90, 171]
-        audio = [torch.rand(dims) - 0.5 for dims in vec_dims]
+        audio = [self._rand_pool[idx : idx + 1, : dims[1]] for idx, dims in enumerate(vec_dims)]
 
         inputs = processor(
             text=[
@@ -185,37 +144,63 @@ class GraniteSpeechProcessorTest(unittest.TestCase):
             return_tensors="pt",
         )
 
-        # Check the number of audio tokens
-        audio_token_id = tokenizer.get_vocab()[processor.audio_token]
-
         # Make sure the number of audio tokens matches the number of features
         num_calculated_features = processor.audio_processor._get_num_audio_features(
             [dims[1] for dims in vec_dims],
         )
-        num_audio_tokens = int(torch.sum(inputs["input_ids"] == audio_token_id))
+        num_audio_tokens = inputs["input_ids"].eq(self._audio_token_id).sum().item()
         assert num_calculated_features == [90, 171]
         assert sum(num_expected_features) == num_audio_tokens
 
+    @torch.inference_mode()
+    def test_audio_token_filling_at_token_level(self):
+        """Ensure expanding the audio tokens after tokenization matches
+        expanding them in the text.
+        """
+        processor = self._processor
+        audio = [self._rand_pool[:1, :142100], self._rand_pool[1:, :269920]]
+        text = [
+            f"{processor.audio_token} Can you describe this audio?",
+            f"{processor.audio_token} How does it compare with this audio?",
+        ]
+
+        # token type ids are also a per-token output, so they need to be expanded as well
+        for kwargs in [{}, {"return_token_type_ids": True}]:
+            with self.subTest(**kwargs):
+                expected = processor(text=text, audio=audio, return_tensors="pt", **kwargs)
+                computed = processor(text=text, audio=audio, return_tensors="pt", expand_at_token_level=True, **kwargs)
+
+                self.assertEqual(computed.keys(), expected.keys())
+                for key in expected:
+                    torch.testing.assert_close(computed[key], expected[key])
+
+    @parameterized.expand([(False,), (True,)])
+    def test_more_audio_tokens_than_audios_raises(self, expand_at_token_level):
+        """Ensure a clear error is raised if there are more audio tokens than audios."""
+        text = self._audio_prompts[2]
+        audio = self._rand_pool[:1, :142100]
+        with pytest.raises(ValueError, match="more audio tokens"):
+            self._processor(text=text, audio=audio, return_tensors="pt", expand_at_token_level=expand_at_token_level)
+
     @require_torch_accelerator
+    @torch.inference_mode()
     def test_device_override(self):
-        """Ensure that we regardless of the processing device, the tensors
-        produced are on the CPU.
+        """Ensure that the text and audio tensors produced are all left on the processing
+        device, unless a return device is provided.
         """
-        tokenizer = self.get_tokenizer()
-        audio_processor = self.get_audio_processor()
-        processor = GraniteSpeechProcessor(
-            tokenizer=tokenizer,
-            audio_processor=audio_processor,
-        )
+        processor = self._processor
 
         vec_dims = [1, 269920]
-        wav = torch.rand(vec_dims) - 0.5
-
-        inputs = processor(
-            text=f"{processor.audio_token} Can you transcribe this audio?",
-            audio=wav,
-            return_tensors="pt",
-            device=torch_device,
-        )
-
-        assert inputs["input_features"].device.type == "cpu"
+        wav = self._rand_pool[: vec_dims[0], : vec_dims[1]]
+        if torch.device(torch_device).type == "cuda":
+            # exercise the asynchronous host to device copy
+            wav = wav.pin_memory()
+
+        text = f"{processor.audio_token} Can you transcribe this audio?"
+        inputs = processor(text=text, audio=wav, return_tensors="pt", device=torch_device)
+        for key, value in inputs.items():
+            assert value.device.type == torch.device(torch_device).type, key
+
+        inputs = processor(text=text, audio=wav, return_tensors="pt", device=torch_device, return_device="cpu")
+        for key, value in inputs.items():
+            assert value.device.type == "cpu", key